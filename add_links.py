@@ -34,9 +34,13 @@
 #
 # ---------------------------------------------------------------------------
 
+import os
 import re
+import shutil
 import fitz  # PyMuPDF
-import statistics
+import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 SRC_PDF = r"ALC.pdf"
 OUT_PDF = r"ALC_ebible_links.pdf"
@@ -59,23 +63,61 @@ abbr_to_code = {
     "Rev": "rev",
 }
 
-alt = "|".join(sorted(map(re.escape, abbr_to_code.keys()), key=len, reverse=True))
-
-# token-level strict matches
-full_re = re.compile(
-    rf"^(?P<book>{alt})\s*(?P<chap>\d+)(?::(?P<v1>\d+)(?:-(?P<v2>\d+))?)?$"
-)
-chapverse_re = re.compile(r"^(?P<chap>\d+):(?P<v1>\d+)(?:-(?P<v2>\d+))?$")
-verseonly_re = re.compile(r"^(?P<v1>\d+)(?:-(?P<v2>\d+))?$")
+def regex_opt(words):
+    """
+    Build an alternation matching exactly `words`, factored on common prefixes
+    (1(?:Co|Jn|Pe|T[hi])|...) so the regex engine walks a trie instead of
+    trying each abbreviation in turn.
+    """
+    trie = {}
+    for w in words:
+        node = trie
+        for c in w:
+            node = node.setdefault(c, {})
+        node[""] = {}  # end of word
+    return _trie_pattern(trie)
+
+def _trie_pattern(node):
+    optional = "" in node
+    branches = [re.escape(c) + _trie_pattern(child) for c, child in sorted(node.items()) if c]
+    if not branches:
+        return ""
+    if len(branches) == 1:
+        pat = branches[0]
+        if optional and len(pat) > 1:
+            pat = f"(?:{pat})"
+    elif all(len(b) == 1 for b in branches):
+        pat = "[" + "".join(branches) + "]"
+    else:
+        pat = "(?:" + "|".join(branches) + ")"
+    return pat + "?" if optional else pat
+
+alt = regex_opt(abbr_to_code.keys())
+
+# Books are numbered for the URL keys; 0 means "no book yet"
+BOOK_CODES = [None] + sorted(set(abbr_to_code.values()))
+abbr_to_book_id = {abbr: BOOK_CODES.index(code) for abbr, code in abbr_to_code.items()}
+NO_BOOK = 0
+NO_NUM = -1
+
+# Token kinds
+FULL = 0
+CHAP_VERSE = 1
+VERSE_ONLY = 2
 
 # Superscript digits (¹²³ and ⁰⁴⁵⁶⁷⁸⁹). Used to ignore footnote markers like 6:14³⁵
-SUPDIG_RE = re.compile(r"[\u00B9\u00B2\u00B3\u2070\u2074-\u2079]+")
-
-# token finder within line_text
-token_re = re.compile(
-    rf"\b(?:{alt})\b\s*\d+(?::\d+(?:-\d+)?)?(?:[\u00B9\u00B2\u00B3\u2070\u2074-\u2079]+)?"
-    r"|\b\d+:\d+(?:-\d+)?(?:[\u00B9\u00B2\u00B3\u2070\u2074-\u2079]+)?"
-    r"|\b\d+(?:-\d+)?(?:[\u00B9\u00B2\u00B3\u2070\u2074-\u2079]+)?\b"
+SUPDIG = r"[\u00B9\u00B2\u00B3\u2070\u2074-\u2079]*"
+
+# token finder within line_text; the named groups tell which kind of reference matched:
+#   book + fchap/fv1/fv2  -> full reference (Mt 7:3-5)
+#   cchap/cv1/cv2         -> chapter:verse (6:14)
+#   vo1/vo2               -> verse-only (11, 18-19)
+# Trailing superscript digits are consumed by the token but never captured.
+# page_links unpacks m.groups() positionally, so keep the group order.
+COMBINED = re.compile(
+    rf"\b(?P<book>{alt})\b\s*(?P<fchap>\d+)(?::(?P<fv1>\d+)(?:-(?P<fv2>\d+))?)?{SUPDIG}"
+    rf"|\b(?P<cchap>\d+):(?P<cv1>\d+)(?:-(?P<cv2>\d+))?{SUPDIG}"
+    rf"|\b(?P<vo1>\d+)(?:-(?P<vo2>\d+))?{SUPDIG}\b"
 )
 
 def make_url(book_code, chap, v1=None, v2=None):
@@ -85,79 +127,124 @@ def make_url(book_code, chap, v1=None, v2=None):
         return f"https://ebible.gr/collate/{book_code}.{chap}.{v1}-{v2}"
     return f"https://ebible.gr/collate/{book_code}.{chap}.{v1}"
 
-def union_rect(rects):
-    rr = None
-    for r in rects:
-        rr = r if rr is None else (rr | r)
-    return rr
+# The same references recur thousands of times in the concordance:
+# (book, chap, v1, v2) -> URL
+URL_CACHE = {}
+
+def url_for_key(key):
+    url = URL_CACHE.get(key)
+    if url is None:
+        url = URL_CACHE[key] = _format_key(key)
+    return url
 
-def line_chars_from_rawdict(page):
+def _format_key(key):
+    book, chap, v1, v2 = key
+    if v1 == NO_NUM:
+        return make_url(BOOK_CODES[book], chap)
+    return make_url(BOOK_CODES[book], chap, v1, v2 if v2 != NO_NUM else None)
+
+def resolve_refs(kinds, books, chaps, v1s, v2s, inherits, ctx_book, ctx_chap):
+    """
+    Apply the context rules to a page's tokens in reading order.
+    Context only changes through tokens, so line breaks need no special care.
+    Returns: URL key per token (None = no link), ctx_book, ctx_chap, resolved
+    """
+    keys = [None] * len(kinds)
+    resolved = False
+    for i in range(len(kinds)):
+        kind = kinds[i]
+        if kind == FULL:
+            ctx_book = books[i]
+            ctx_chap = chaps[i]
+            resolved = True
+            keys[i] = (ctx_book, ctx_chap, v1s[i], v2s[i])
+        elif kind == CHAP_VERSE:
+            if ctx_book != NO_BOOK:
+                ctx_chap = chaps[i]
+                keys[i] = (ctx_book, ctx_chap, v1s[i], v2s[i])
+        elif ctx_book != NO_BOOK and ctx_chap > 0 and inherits[i]:
+            # ✅ verse-only can inherit at start-of-line too
+            keys[i] = (ctx_book, ctx_chap, v1s[i], v2s[i])
+    return keys, ctx_book, ctx_chap, resolved
+
+def _num(group):
+    return int(group) if group is not None else NO_NUM
+
+# Lines without any digit cannot hold a reference, so their char arrays are never needed.
+DIGIT_RE = re.compile(r"\d")
+
+TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Any book abbreviation on a page; without one (and no book context) no token can become a link
+BOOK_PREFILTER = re.compile(alt)
+
+def line_chars_from_rawdict(tp):
     """
-    Yield lines as list of char records (per-character bbox + span font size).
+    Yield lines as (block_no, line_no, chars, bboxes, sizes): the line's chars
+    as one string with parallel arrays of per-char bboxes (N x 4) and span
+    font sizes (N). Lines without a digit are skipped before any array is built.
+    tp is the page's TextPage, created with TEXT_FLAGS.
     """
-    d = page.get_text("rawdict")
+    d = tp.extractRAWDICT()
     for b_idx, block in enumerate(d.get("blocks", [])):
         if block.get("type") != 0:
             continue
         for l_idx, line in enumerate(block.get("lines", [])):
-            out = []
-            for span in line.get("spans", []):
-                size = float(span.get("size", 0.0) or 0.0)
-                for ch in span.get("chars", []):
-                    c = ch.get("c", "")
-                    rect = fitz.Rect(ch.get("bbox"))
-                    out.append({
-                        "c": c,
-                        "rect": rect,
-                        "size": size,
-                        "block_no": b_idx,
-                        "line_no": l_idx
-                    })
-            yield out
-
-def build_line_text_and_map(chars, sup_ratio=0.85):
+            spans = line.get("spans", [])
+            glyphs = [ch for span in spans for ch in span.get("chars", [])]
+
+            chars = "".join(ch["c"] for ch in glyphs)
+            if not DIGIT_RE.search(chars):
+                continue
+            bboxes = np.array([ch["bbox"] for ch in glyphs], dtype=np.float32).reshape(-1, 4)
+            sizes = np.repeat(
+                np.array([float(span.get("size", 0.0) or 0.0) for span in spans], dtype=np.float32),
+                [len(span.get("chars", [])) for span in spans],
+            )
+            yield b_idx, l_idx, chars, bboxes, sizes
+
+def build_line_text_and_map(chars, bboxes, sizes, sup_ratio=0.85):
     """
     Build line_text from chars while removing superscript digits by font size.
-    Returns: line_text, char_rects, meta
+    Every rawdict char holds exactly one code point, so chars stays
+    index-aligned with bboxes and sizes.
+    Returns: line_text, char_rects (N x 4 array of char bboxes), meta
     """
-    sizes = [x["size"] for x in chars if x["c"].strip() and x["size"]]
-    base = statistics.median(sizes) if sizes else 0.0
+    sizes = sizes.tolist()
+    measured = [size for c, size in zip(chars, sizes) if size and not c.isspace()]
+    # most common size is the body text size (sizes cluster on a couple of values)
+    base = Counter(measured).most_common(1)[0][0] if measured else 0.0
+    small = sup_ratio * base if base > 0 else 0.0
+
+    # drop brackets always (covers [05]) and digits set smaller than the body text
+    keep = [
+        i for i, (c, size) in enumerate(zip(chars, sizes))
+        if c not in "[]" and not (size < small and c.isdigit())
+    ]
+    removed_sup = len(chars) - len(keep)
+
+    if removed_sup:
+        line_text = "".join([chars[i] for i in keep])
+        char_rects = bboxes[keep]
+    else:
+        # most lines lose nothing: reuse the extracted string and arrays as they are
+        line_text = chars
+        char_rects = bboxes
 
-    line_text_parts = []
-    char_rects = []
-    removed_sup = 0
-
-    for x in chars:
-        c = x["c"]
-        if c == "":
-            continue
-
-        # drop brackets always (covers [05])
-        if c in "[]":
-            removed_sup += 1
-            continue
-
-        is_digit = c.isdigit()
-        is_small = (base > 0 and x["size"] < sup_ratio * base)
-
-        if is_small and is_digit:
-            removed_sup += 1
-            continue
-
-        line_text_parts.append(c)
-        char_rects.append(x["rect"])
-
-    line_text = "".join(line_text_parts)
     return line_text, char_rects, {"base_size": base, "removed_sup_chars": removed_sup}
 
 def rect_for_span_chars(char_rects, s, e):
     rects = char_rects[s:e]
-    if not rects:
-        return None
-    rr = union_rect(rects)
-    if rr is None:
+    if not len(rects):
         return None
-    return fitz.Rect(rr.x0 - 0.3, rr.y0 - 0.3, rr.x1 + 0.3, rr.y1 + 0.3)
+    # empty char boxes don't widen the union (same as fitz.Rect "|")
+    solid = rects[(rects[:, 0] < rects[:, 2]) & (rects[:, 1] < rects[:, 3])]
+    if len(solid):
+        x0, y0 = solid[:, :2].min(axis=0).tolist()
+        x1, y1 = solid[:, 2:].max(axis=0).tolist()
+    else:
+        x0, y0, x1, y1 = rects[0].tolist()
+    return fitz.Rect(x0 - 0.3, y0 - 0.3, x1 + 0.3, y1 + 0.3)
 
 def inherits_context_at(line_text, start_idx):
     """
@@ -177,100 +264,183 @@ def inherits_context_at(line_text, start_idx):
         return True
     return line_text[j] in {",", ";"}  # treat line-break as implicit delimiter
 
-def add_links(doc):
-    logged = 0
+def page_links(page, ctx_book, ctx_chap):
+    """
+    Detect references on one page, starting from the context (book id,
+    chapter) carried over from the previous page.
+    Returns: links [(rect, uri)], ctx_book, ctx_chap, resolved
+    resolved is True once a full reference was seen on the page; from then on
+    the result no longer depends on the incoming context.
+    """
+    tp = page.get_textpage(flags=TEXT_FLAGS)
+    if ctx_book == NO_BOOK and not BOOK_PREFILTER.search(tp.extractText()):
+        return [], ctx_book, ctx_chap, False
+
+    kinds, books, chaps, v1s, v2s, inherits = [], [], [], [], [], []
+    spans = []
+
+    for block_no, line_no, chars, bboxes, sizes in line_chars_from_rawdict(tp):
+        if not chars:
+            continue
+
+        line_text, char_rects, meta = build_line_text_and_map(chars, bboxes, sizes, sup_ratio=0.85)
+
+        # Classify tokens in this line; context is applied per page by resolve_refs
+        for m in COMBINED.finditer(line_text):
+            s, e = m.span()
+
+            # one call fetches every group; the alternative that fired is the one with a value
+            book, fchap, fv1, fv2, cchap, cv1, cv2, vo1, vo2 = m.groups()
+            if book is not None:
+                kind = FULL
+                nums = (_num(fchap), _num(fv1), _num(fv2))
+            elif cchap is not None:
+                kind = CHAP_VERSE
+                nums = (_num(cchap), _num(cv1), _num(cv2))
+            else:
+                kind = VERSE_ONLY
+                nums = (NO_NUM, _num(vo1), _num(vo2))
+
+            kinds.append(kind)
+            books.append(abbr_to_book_id[book] if book is not None else NO_BOOK)
+            chaps.append(nums[0])
+            v1s.append(nums[1])
+            v2s.append(nums[2])
+            inherits.append(kind == VERSE_ONLY and inherits_context_at(line_text, s))
+            spans.append((char_rects, s, e))
+
+    keys, ctx_book, ctx_chap, resolved = resolve_refs(
+        kinds, books, chaps, v1s, v2s, inherits, ctx_book, ctx_chap
+    )
+    links = []
+    for key, (char_rects, s, e) in zip(keys, spans):
+        if key is None:
+            continue
+        rr = rect_for_span_chars(char_rects, s, e)
+        if not rr:
+            continue
+        links.append((rr, url_for_key(key)))
+
+    return links, ctx_book, ctx_chap, resolved
+
+# /NM names of inserted links: fitz-L0, fitz-L1, ... (as page.insert_link names them)
+LINK_NAME_STEM = "fitz-L"
+
+def insert_uri_links(page, links):
+    """
+    Insert [(rect, uri)] as URI link annotations with a single /Annots update.
+    page.insert_link re-reads all annotations of the page on every call to
+    pick a fresh /NM name, which is quadratic on reference-dense pages.
+    Existing /Annots items are kept as they are.
+    """
+    if not links:
+        return
+    doc = page.parent
+    ictm = ~page.transformation_matrix
+    names = {x[2] for x in page.annot_xrefs()}
+
+    refs = []
+    i = 0
+    for rr, uri in links:
+        while f"{LINK_NAME_STEM}{i}" in names:
+            i += 1
+        rect = " ".join(f"{v:.4f}" for v in fitz.Rect(rr) * ictm)
+        xref = doc.get_new_xref()
+        doc.update_object(
+            xref,
+            f"<</Type/Annot/Subtype/Link/Rect[{rect}]/BS<</W 0>>"
+            f"/A<</S/URI/URI{fitz.get_pdf_str(uri)}>>/NM({LINK_NAME_STEM}{i})>>",
+        )
+        refs.append(f"{xref} 0 R")
+        i += 1
+    refs = " ".join(refs)
+
+    kind, value = doc.xref_get_key(page.xref, "Annots")
+    if kind == "xref":
+        # /Annots is an indirect array object: extend that object
+        annots_xref = int(value.split()[0])
+        old = doc.xref_object(annots_xref, compressed=True).strip()
+        doc.update_object(annots_xref, f"{old[:-1]} {refs}]")
+    elif kind == "array":
+        doc.xref_set_key(page.xref, "Annots", f"{value.strip()[:-1]} {refs}]")
+    else:
+        doc.xref_set_key(page.xref, "Annots", f"[{refs}]")
+
+_worker_doc = None
+
+def _init_worker(path):
+    global _worker_doc
+    _worker_doc = fitz.open(path)
+
+def _links_for_pages(pnos):
+    """
+    Worker: detect references on a run of pages, starting without context.
+    Returns one (pno, links, ctx_book, ctx_chap) record per page.
+    """
+    out = []
+    ctx_book = NO_BOOK
+    ctx_chap = NO_NUM
+    for pno in pnos:
+        links, ctx_book, ctx_chap, _ = page_links(_worker_doc[pno], ctx_book, ctx_chap)
+        out.append((pno, [(tuple(rr), url) for rr, url in links], ctx_book, ctx_chap))
+    return out
+
+def add_links(doc, src_path=None):
+    """
+    Add reference links to every page of doc; returns the number of links.
+    With src_path and more than one CPU, pages are scanned by worker processes
+    that reopen src_path, so it must be a file with the same content as doc
+    (e.g. the unmodified file doc was opened from). Otherwise all pages are
+    scanned in this process.
+    """
     total_added = 0
+    npages = len(doc)
+    if hasattr(os, "sched_getaffinity"):
+        ncpu = len(os.sched_getaffinity(0))  # CPUs this process may run on
+    else:
+        ncpu = os.cpu_count() or 1
+
+    # pno -> (links, ctx_book, ctx_chap) as scanned by a worker, chunks starting without context
+    scanned = {}
+    chunk_starts = set()
+    if src_path and ncpu > 1:
+        chunksize = max(1, npages // (4 * ncpu))
+        chunks = [range(start, min(start + chunksize, npages)) for start in range(0, npages, chunksize)]
+        chunk_starts = {chunk[0] for chunk in chunks}
+        with ProcessPoolExecutor(max_workers=ncpu, initializer=_init_worker, initargs=(src_path,)) as ex:
+            for chunk in ex.map(_links_for_pages, chunks):
+                for pno, links, book, chap in chunk:
+                    scanned[pno] = (links, book, chap)
 
     # ✅ GLOBAL context across lines (and pages)
-    ctx_book = None
-    ctx_chap = None
+    ctx_book = NO_BOOK
+    ctx_chap = NO_NUM
+    inherited = False
 
-    for pno in range(len(doc)):
+    for pno in range(npages):
         page = doc[pno]
-
-        for chars in line_chars_from_rawdict(page):
-            if not chars:
-                continue
-
-            block_no = chars[0]["block_no"]
-            line_no = chars[0]["line_no"]
-
-            line_text, char_rects, meta = build_line_text_and_map(chars, sup_ratio=0.85)
-
-            # ✅ Start line with previous context
-            current_book = ctx_book
-            current_chap = ctx_chap
-
-            # Process tokens in this line
-            for m in token_re.finditer(line_text):
-                token = m.group(0)
-                s, e = m.span()
-                token_clean = SUPDIG_RE.sub("", token)
-
-                url = None
-                rule = None
-
-                fm = full_re.match(token_clean)
-                if fm:
-                    code = abbr_to_code.get(fm.group("book"))
-                    if not code:
-                        continue
-                    chap = int(fm.group("chap"))
-                    v1 = fm.group("v1")
-                    v2 = fm.group("v2")
-
-                    current_book = code
-                    current_chap = chap
-                    rule = "FULL"
-
-                    if v1 is None:
-                        url = make_url(code, chap)
-                    else:
-                        url = make_url(code, chap, int(v1), int(v2) if v2 else None)
-
-                else:
-                    cv = chapverse_re.match(token_clean)
-                    if cv and current_book:
-                        chap = int(cv.group("chap"))
-                        v1 = int(cv.group("v1"))
-                        v2 = int(cv.group("v2")) if cv.group("v2") else None
-
-                        current_chap = chap
-                        rule = "CHAP:VERSE"
-                        url = make_url(current_book, chap, v1, v2)
-
-                    else:
-                        vo = verseonly_re.match(token_clean)
-                        if vo and current_book and current_chap and inherits_context_at(line_text, s):
-                            # ✅ verse-only can inherit at start-of-line too
-                            v1 = int(vo.group("v1"))
-                            v2 = int(vo.group("v2")) if vo.group("v2") else None
-                            rule = "VERSE_ONLY_INHERIT"
-                            url = make_url(current_book, current_chap, v1, v2)
-
-                if not url:
-                    continue
-
-                rr = rect_for_span_chars(char_rects, s, e)
-                if not rr:
-                    continue
-
-                page.insert_link({"kind": fitz.LINK_URI, "from": rr, "uri": url, "is_external": True})
-                total_added += 1
-
-            # ✅ Save context for NEXT line (only if we learned something)
-            if current_book is not None:
-                ctx_book = current_book
-            if current_chap is not None:
-                ctx_chap = current_chap
+        # A chunk's pages only depend on the real incoming context until its first full reference
+        if pno in chunk_starts:
+            inherited = ctx_book != NO_BOOK or ctx_chap != NO_NUM
+        if inherited or pno not in scanned:
+            links, ctx_book, ctx_chap, resolved = page_links(page, ctx_book, ctx_chap)
+            inherited = inherited and not resolved
+        else:
+            links, ctx_book, ctx_chap = scanned[pno]
+
+        insert_uri_links(page, links)
+        total_added += len(links)
 
     return total_added
 
 def main():
-    doc = fitz.open(SRC_PDF)
-    total = add_links(doc)
+    # Links are appended to a copy of the source as an incremental update,
+    # so the untouched page and font streams are never rewritten.
+    shutil.copyfile(SRC_PDF, OUT_PDF)
+    doc = fitz.open(OUT_PDF)
+    total = add_links(doc, src_path=SRC_PDF)
 
-    doc.save(OUT_PDF, deflate=True)
+    doc.save(OUT_PDF, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
     doc.close()
     print(f"Done. Links added: {total}")
     print(f"Output: {OUT_PDF}")